@@ -1,81 +1,58 @@
+import copy
 import io
+import json
+import multiprocessing
 import os
+import shutil
 import ssl
+import tempfile
 import zipfile
 import urllib.request
 import urllib.error
-from typing import Dict, List, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
 
+import numpy as np
 import streamlit as st
+from lxml import etree as LET
 
-from io_utils import (
-    convert_csv_bytes,
-    convert_docx_bytes,
-    convert_xml_bytes,
-    read_text_bytes,
-    texts_to_csv_bytes,
-    texts_to_txt_bytes,
-    texts_to_xml_bytes,
-    write_csv,
-)
-from mecab_utils import convert_text, create_tagger
+from file_convert import init_worker, process_file
+from mecab_utils import convert_texts, create_tagger
 
 
 _UNIDIC_WAKA_ZIP_URL = "https://clrd.ninjal.ac.jp/unidic_archive/2512/unidic-waka-v202512.zip"
 
+# 和歌各句の想定文字数（5-7-5-7-7）
+_EXPECTED_COUNTS = np.array([5, 7, 5, 7, 7], dtype=np.int32)
+
+# ローカル名でタグを探すXPath（名前空間の有無を問わない）
+_XPATH_BY_LOCAL_NAME = LET.XPath("//*[local-name() = $name]")
+_XPATH_SELF_OR_DESCENDANT = LET.XPath("descendant-or-self::*[local-name() = $name]")
+
 
 def _ext(name: str) -> str:
     # 拡張子を小文字で返す
     return os.path.splitext(name.lower())[1]
 
 
-def _as_output_bytes(
-    output_format: str,
-    texts: List[str],
-) -> Tuple[bytes, str]:
-    # 指定形式に合わせて出力バイト列とMIMEを返す
-    if output_format == "txt":
-        return texts_to_txt_bytes(texts), "text/plain"
-    if output_format == "csv":
-        return texts_to_csv_bytes(texts), "text/csv"
-    if output_format == "xml":
-        return texts_to_xml_bytes(texts), "application/xml"
-    raise ValueError(f"Unsupported output format: {output_format}")
-
-
-def _local_name(tag: str) -> str:
-    # 名前空間付きタグからローカル名だけを取り出す
-    return tag.split("}", 1)[1] if "}" in tag else tag
-
-
-def _load_xml_with_sourceline(data: bytes):
-    # 行番号を取るためにiterparseを使ってXMLを読み込む
-    import xml.etree.ElementTree as ET
-
-    parser = ET.XMLParser()
-    it = ET.iterparse(io.BytesIO(data), events=("start",), parser=parser)
-    elements = []
-    for _, elem in it:
-        elements.append(elem)
-    return ET.ElementTree(elements[0]) if elements else None
+def _parse_xml(data: bytes):
+    # lxmlでXMLを読み込む（各要素のsourcelineに行番号が入る。コメント/PIは除く）
+    parser = LET.XMLParser(remove_comments=True, remove_pis=True)
+    return LET.parse(io.BytesIO(data), parser)
 
 
 def _extract_l_and_seg(tree, l_tag: str, seg_tag: str):
     # <l>とその配下の<seg>を抽出する
-    root = tree.getroot()
-    l_items = []
-    for elem in root.iter():
-        if _local_name(elem.tag) != l_tag:
-            continue
-        segs = [s for s in elem.iter() if _local_name(s.tag) == seg_tag]
-        l_items.append((elem, segs))
-    return l_items
+    return [
+        (elem, _XPATH_SELF_OR_DESCENDANT(elem, name=seg_tag))
+        for elem in _XPATH_BY_LOCAL_NAME(tree, name=l_tag)
+    ]
 
 
 def _index_l_elements(tree, l_tag: str) -> List:
     # <l>要素を順番通りに取得する
-    root = tree.getroot()
-    return [e for e in root.iter() if _local_name(e.tag) == l_tag]
+    return _XPATH_BY_LOCAL_NAME(tree, name=l_tag)
 
 
 def _map_original_l(orig_tree, l_tag: str):
@@ -94,21 +71,10 @@ def _map_original_l(orig_tree, l_tag: str):
 
 
 def _seg_text(seg) -> str:
-    # seg内のテキストだけ取得（rdg/rtは除外）
-    parts: List[str] = []
-
-    def walk(node):
-        if _local_name(node.tag) in ("rdg", "rt"):
-            return
-        if node.text:
-            parts.append(node.text)
-        for child in list(node):
-            walk(child)
-            if child.tail:
-                parts.append(child.tail)
-
-    walk(seg)
-    return "".join(parts)
+    # seg内のテキストだけ取得（rdg/rtは除外）。コピー上で要素ごと取り除いてからC側で連結する
+    pruned = copy.deepcopy(seg)
+    LET.strip_elements(pruned, "{*}rdg", "{*}rt", with_tail=False)
+    return "".join(pruned.itertext())
 
 
 def _has_dicrc(path: str) -> bool:
@@ -116,14 +82,55 @@ def _has_dicrc(path: str) -> bool:
     return bool(path) and os.path.isfile(os.path.join(path, "dicrc"))
 
 
-def _find_dicrc_dir(root: str) -> str:
-    # 配下からdicrcを探してその親フォルダを返す
+@st.cache_data(show_spinner=False)
+def _find_dicrc_dir(root: str, root_mtime: float) -> str:
+    # 配下からdicrcを探してその親フォルダを返す（rootの更新時刻ごとに結果をキャッシュ）
     for dirpath, _, filenames in os.walk(root):
         if "dicrc" in filenames:
             return dirpath
     return ""
 
 
+@st.cache_resource(show_spinner=False)
+def _cached_tagger(dic_dir: str, mecabrc_path: Optional[str], reading_field: int):
+    # Taggerの生成は辞書の読み込みが重いため、同じ設定ならタブ・再実行をまたいで再利用する
+    return create_tagger(dic_dir, mecabrc_path, reading_field)
+
+
+# 合計サイズがこれ未満の場合はプロセスプールを使わずにこのプロセスで変換する
+# （小さなファイルでは、ワーカーの起動や受け渡しの方が変換より重くなるため）
+_POOL_MIN_TOTAL_BYTES = 4 * 1024 * 1024
+
+
+@st.cache_resource(show_spinner=False)
+def _cached_executor(dic_dir: str, mecabrc_path: Optional[str], reading_field: int):
+    # 複数ファイル変換用のプロセスプール。ワーカーとその中のTaggerを再実行をまたいで使い回す
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count() or 1,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(dic_dir, mecabrc_path, reading_field),
+    )
+
+
+def _load_json(path: str) -> Dict[str, str]:
+    # JSONファイルを読み込む（無い・壊れている場合は空dict）
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _download_error(e: Exception) -> RuntimeError:
+    # 自動ダウンロード失敗時の案内メッセージ
+    return RuntimeError(
+        f"辞書データの自動ダウンロードに失敗しました。\n"
+        f"サイドバーの「辞書の手動設定」から、手元でダウンロードしたZIPファイルをアップロードしてください。\n"
+        f"詳細エラー: {e}"
+    )
+
+
 def _ensure_unidic_waka(preferred_dir: str) -> str:
     # dicrcが無い場合はサーバー側でUniDicを自動取得する
     if _has_dicrc(preferred_dir):
@@ -134,29 +141,88 @@ def _ensure_unidic_waka(preferred_dir: str) -> str:
     if _has_dicrc(target_dir):
         return target_dir
 
+    zip_cache_path = os.path.join(cache_root, "unidic-waka.zip")
+    meta_path = zip_cache_path + ".meta.json"
+    tmp_path = zip_cache_path + ".part"
+    sentinel_path = os.path.join(cache_root, ".extracted_ok")
+
+    # 展開済みの目印が同じURL・同じZIPのものなら、ZIPを開かずにそのまま使う
+    marker = _load_json(sentinel_path)
+    if (
+        marker.get("url") == _UNIDIC_WAKA_ZIP_URL
+        and _has_dicrc(marker.get("dic_dir", ""))
+        and (
+            not os.path.isfile(zip_cache_path)
+            or marker.get("zip_size") == os.path.getsize(zip_cache_path)
+        )
+    ):
+        return marker["dic_dir"]
+
     os.makedirs(cache_root, exist_ok=True)
+    downloaded = False
 
     # SSL検証無効化とUser-Agent設定（ブロック回避用）
     ctx = ssl.create_default_context()
     ctx.check_hostname = False
     ctx.verify_mode = ssl.CERT_NONE
-    req = urllib.request.Request(_UNIDIC_WAKA_ZIP_URL, headers={"User-Agent": "Mozilla/5.0"})
+    headers = {"User-Agent": "Mozilla/5.0"}
+
+    # 前回取得したZIPがあれば、ETag/Last-Modifiedで更新の有無だけを問い合わせる
+    meta = _load_json(meta_path) if os.path.isfile(zip_cache_path) else {}
+    if meta.get("url") == _UNIDIC_WAKA_ZIP_URL:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    req = urllib.request.Request(_UNIDIC_WAKA_ZIP_URL, headers=headers)
 
     try:
-        with urllib.request.urlopen(req, context=ctx, timeout=60) as resp:
-            zip_data = resp.read()
+        # 一時ファイルへ直接書き出し、完了後に置き換える（途中失敗しても前回のZIPは壊れない）
+        with urllib.request.urlopen(req, context=ctx, timeout=60) as resp, open(
+            tmp_path, "wb"
+        ) as f:
+            shutil.copyfileobj(resp, f, 1 << 20)
+            new_meta = {
+                "url": _UNIDIC_WAKA_ZIP_URL,
+                "etag": resp.headers.get("ETag", ""),
+                "last_modified": resp.headers.get("Last-Modified", ""),
+            }
+        os.replace(tmp_path, zip_cache_path)
+        downloaded = True
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(new_meta, f)
+    except urllib.error.HTTPError as e:
+        # 304 Not Modified の場合は手元のZIPをそのまま使う
+        if e.code != 304:
+            raise _download_error(e)
     except (urllib.error.URLError, OSError) as e:
-        raise RuntimeError(
-            f"辞書データの自動ダウンロードに失敗しました。\n"
-            f"サイドバーの「辞書の手動設定」から、手元でダウンロードしたZIPファイルをアップロードしてください。\n"
-            f"詳細エラー: {e}"
-        )
-
-    with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
-        zf.extractall(cache_root)
+        raise _download_error(e)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    with zipfile.ZipFile(zip_cache_path) as zf:
+        # ZIP内のdicrcの位置から展開先を求め、未更新で展開済みなら展開を省く
+        dicrc_names = [n for n in zf.namelist() if os.path.basename(n) == "dicrc"]
+        found = os.path.join(cache_root, os.path.dirname(dicrc_names[0])) if dicrc_names else ""
+        if downloaded or not _has_dicrc(found):
+            zf.extractall(cache_root)
+
+    if not _has_dicrc(found):
+        found = _find_dicrc_dir(cache_root, os.path.getmtime(cache_root))
+    if not found:
+        return preferred_dir
 
-    found = _find_dicrc_dir(cache_root)
-    return found if found else preferred_dir
+    with open(sentinel_path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "url": _UNIDIC_WAKA_ZIP_URL,
+                "zip_size": os.path.getsize(zip_cache_path),
+                "dic_dir": found,
+            },
+            f,
+        )
+    return found
 
 
 # 画面設定とタイトル
@@ -245,7 +311,7 @@ tab_convert, tab_check = st.tabs(["変換", "和歌XMLチェック"])
 
 preview_items = []
 if "check_xml_pairs" not in st.session_state:
-    st.session_state["check_xml_pairs"] = []
+    st.session_state["check_xml_pairs"] = {}
 
 with tab_convert:
     uploaded = st.file_uploader(
@@ -266,244 +332,94 @@ with tab_convert:
             st.stop()
         try:
             # MeCabの初期化
-            tagger = create_tagger(dic_dir_to_use, mecabrc_path or None, 20)
+            tagger = _cached_tagger(dic_dir_to_use, mecabrc_path or None, 20)
         except Exception as exc:
             st.error(f"MeCabの初期化に失敗しました: {exc}")
             st.stop()
 
-        zip_buffer = io.BytesIO()
-        zip_file = zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_DEFLATED)
-
-        for file in uploaded:
-            # ファイルごとに処理
-            name = file.name
-            data = file.read()
-            ext = _ext(name)
+        # ZIPは作成中、16MBまではメモリ上・それを超えたら一時ファイルに書き出す
+        # （作成中に出力を積み上げないためのもので、ダウンロード時には全体をメモリに読み込む）
+        zip_buffer = tempfile.SpooledTemporaryFile(max_size=16 * 1024 * 1024)
+        zip_file = zipfile.ZipFile(
+            zip_buffer, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1
+        )
 
+        options = {
+            "expand_odoriji": expand_odoriji,
+            "output_mode": "katakana" if output_mode == "カタカナ" else "hiragana",
+            "output_format": output_format,
+            "xml_tag": xml_tag,
+            "csv_column": csv_column,
+        }
+        jobs = [(file.name, file.getvalue(), _ext(file.name)) for file in uploaded]
+        # 変換の進み具合をファイル単位で表示する（結果の表示はアップロード順）
+        progress = st.progress(0.0, text=f"変換中... 0/{len(jobs)}")
+        results: List[Optional[Dict[str, object]]] = [None] * len(jobs)
+        if len(jobs) > 1 and sum(len(data) for _, data, _ in jobs) >= _POOL_MIN_TOTAL_BYTES:
+            # 大きな複数ファイルは常駐のプロセスプールで並列に変換（Taggerは各プロセスで生成済み）
+            executor = _cached_executor(dic_dir_to_use, mecabrc_path or None, 20)
+            try:
+                futures = {
+                    executor.submit(process_file, name, data, ext, options): i
+                    for i, (name, data, ext) in enumerate(jobs)
+                }
+                for done, future in enumerate(as_completed(futures), start=1):
+                    results[futures[future]] = future.result()
+                    progress.progress(done / len(jobs), text=f"変換中... {done}/{len(jobs)}")
+            except BrokenProcessPool:
+                # ワーカーが落ちた場合はプールを作り直せるよう破棄し、残りをこのプロセスで変換する
+                _cached_executor.clear()
+                for i, job in enumerate(jobs):
+                    if results[i] is None:
+                        results[i] = process_file(*job, options, tagger)
+        else:
+            # 小さなバッチはこのプロセスで順に変換し、1ファイルごとに進み具合を更新する
+            for done, job in enumerate(jobs, start=1):
+                results[done - 1] = process_file(*job, options, tagger)
+                progress.progress(done / len(jobs), text=f"変換中... {done}/{len(jobs)}")
+        progress.empty()
+
+        for (name, _, _), result in zip(jobs, results):
+            # ファイルごとに結果を表示
             st.subheader(name)
 
-            if ext == ".txt":
-                # txt: 全文を変換
-                text = read_text_bytes(data)
-                converted = convert_text(
-                    text,
-                    tagger,
-                    expand_odoriji,
-                    "katakana" if output_mode == "カタカナ" else "hiragana",
-                )
-                out_bytes, mime = _as_output_bytes(output_format, [converted])
-                out_name = f"{os.path.splitext(name)[0]}.{output_format}"
-                if zip_download:
-                    zip_file.writestr(out_name, out_bytes)
-                else:
-                    st.download_button("ダウンロード", data=out_bytes, file_name=out_name, mime=mime)
-                preview_items.append((out_name, text, converted))
-
-            elif ext == ".docx":
-                # docx: 段落ごとに変換してtxt/docx両方出力
-                txt_bytes, docx_bytes = convert_docx_bytes(
-                    data,
-                    lambda t: convert_text(
-                        t,
-                        tagger,
-                        expand_odoriji,
-                        "katakana" if output_mode == "カタカナ" else "hiragana",
-                    ),
-                )
-                base = os.path.splitext(name)[0]
-                if zip_download:
-                    zip_file.writestr(f"{base}.txt", txt_bytes)
-                    zip_file.writestr(f"{base}.docx", docx_bytes)
-                else:
-                    st.download_button(
-                        "TXTをダウンロード",
-                        data=txt_bytes,
-                        file_name=f"{base}.txt",
-                        mime="text/plain",
-                    )
-                    st.download_button(
-                        "DOCXをダウンロード",
-                        data=docx_bytes,
-                        file_name=f"{base}.docx",
-                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                    )
-                try:
-                    preview_text = txt_bytes.decode("utf-8-sig", errors="replace")
-                    preview_items.append((f"{base}.txt", preview_text, preview_text))
-                except Exception:
-                    pass
-
-            elif ext == ".csv":
-                # csv: 指定列のみ変換して構造を保持
-                try:
-                    df = convert_csv_bytes(
-                        data,
-                        csv_column,
-                        lambda t: convert_text(
-                            t,
-                            tagger,
-                            expand_odoriji,
-                            "katakana" if output_mode == "カタカナ" else "hiragana",
-                        ),
-                    )
-                except KeyError as exc:
-                    st.error(str(exc))
-                    continue
-                converted_texts = df[csv_column].astype(str).tolist()
-                if output_format == "csv":
-                    out_bytes = write_csv(df)
-                    out_name = f"{os.path.splitext(name)[0]}.csv"
-                    if zip_download:
-                        zip_file.writestr(out_name, out_bytes)
-                    else:
-                        st.download_button(
-                            "ダウンロード",
-                            data=out_bytes,
-                            file_name=out_name,
-                            mime="text/csv",
-                        )
-                    try:
-                        import pandas as _pd
-                        import io as _io
-
-                        src_df = _pd.read_csv(_io.BytesIO(data), encoding="utf-8", engine="python")
-                        original_col = src_df[csv_column].astype(str).tolist()
-                        preview_items.append((out_name, "\n".join(original_col), "\n".join(converted_texts)))
-                    except Exception:
-                        preview_items.append((out_name, "\n".join(converted_texts), "\n".join(converted_texts)))
-                else:
-                    out_bytes, mime = _as_output_bytes(output_format, converted_texts)
-                    out_name = f"{os.path.splitext(name)[0]}.{output_format}"
-                    if zip_download:
-                        zip_file.writestr(out_name, out_bytes)
-                    else:
-                        st.download_button("ダウンロード", data=out_bytes, file_name=out_name, mime=mime)
-                    try:
-                        import pandas as _pd
-                        import io as _io
-
-                        src_df = _pd.read_csv(_io.BytesIO(data), encoding="utf-8", engine="python")
-                        original_col = src_df[csv_column].astype(str).tolist()
-                        preview_items.append((out_name, "\n".join(original_col), "\n".join(converted_texts)))
-                    except Exception:
-                        preview_items.append((out_name, "\n".join(converted_texts), "\n".join(converted_texts)))
-
-            elif ext == ".xml":
-                # xml: 指定タグ配下のテキストのみ変換
-                try:
-                    xml_bytes = convert_xml_bytes(
-                        data,
-                        xml_tag,
-                        lambda t: convert_text(
-                            t,
-                            tagger,
-                            expand_odoriji,
-                            "katakana" if output_mode == "カタカナ" else "hiragana",
-                        ),
-                        pre_expand_odoriji=expand_odoriji,
-                    )
-                except Exception as exc:
-                    st.error(f"XMLの読み込みに失敗しました: {exc}")
-                    continue
+            if result["error"]:
+                st.error(result["error"])
+                continue
+            if result["warning"]:
+                st.warning(result["warning"])
+                continue
 
-                if output_format == "xml":
-                    # xmlとして出力
-                    out_name = f"{os.path.splitext(name)[0]}.xml"
-                    if zip_download:
-                        zip_file.writestr(out_name, xml_bytes)
-                    else:
-                        st.download_button(
-                            "ダウンロード",
-                            data=xml_bytes,
-                            file_name=out_name,
-                            mime="application/xml",
-                        )
-                    try:
-                        import xml.etree.ElementTree as ET
-
-                        orig_root = ET.fromstring(data)
-                        orig_snippets = []
-                        for elem in orig_root.iter():
-                            if _local_name(elem.tag) != xml_tag:
-                                continue
-                            orig_snippets.append(ET.tostring(elem, encoding="unicode"))
-
-                        conv_root = ET.fromstring(xml_bytes)
-                        conv_snippets = []
-                        for elem in conv_root.iter():
-                            if _local_name(elem.tag) != xml_tag:
-                                continue
-                            conv_snippets.append(ET.tostring(elem, encoding="unicode"))
-
-                        preview_items.append((out_name, "\n".join(orig_snippets), "\n".join(conv_snippets)))
-                    except Exception:
-                        pass
+            for label, out_name, out_bytes, mime in result["outputs"]:
+                if zip_download:
+                    # docxは既にZIP圧縮済みのため、再圧縮せずにそのまま格納する
+                    compress_type = zipfile.ZIP_STORED if out_name.endswith(".docx") else None
+                    zip_file.writestr(out_name, out_bytes, compress_type=compress_type)
                 else:
-                    # xml以外の場合は本文だけを抽出して出力
-                    try:
-                        root = xml_bytes.decode("utf-8")
-                    except UnicodeDecodeError:
-                        root = xml_bytes.decode("utf-8", errors="replace")
-                    texts = []
-                    import xml.etree.ElementTree as ET
-
-                    parsed = ET.fromstring(root)
-                    for elem in parsed.iter():
-                        if _local_name(elem.tag) != xml_tag:
-                            continue
-                        texts.append("".join(elem.itertext()))
-                    out_bytes, mime = _as_output_bytes(output_format, texts)
-                    out_name = f"{os.path.splitext(name)[0]}.{output_format}"
-                    if zip_download:
-                        zip_file.writestr(out_name, out_bytes)
-                    else:
-                        st.download_button("ダウンロード", data=out_bytes, file_name=out_name, mime=mime)
-                    try:
-                        import xml.etree.ElementTree as ET
-
-                        orig_root = ET.fromstring(data)
-                        orig_snippets = []
-                        for elem in orig_root.iter():
-                            if _local_name(elem.tag) != xml_tag:
-                                continue
-                            orig_snippets.append(ET.tostring(elem, encoding="unicode"))
-                        preview_items.append((out_name, "\n".join(orig_snippets), "\n".join(texts)))
-                    except Exception:
-                        pass
+                    st.download_button(label, data=out_bytes, file_name=out_name, mime=mime)
+            if result["preview"] is not None:
+                preview_items.append(result["preview"])
 
+            xml_pair = result["xml_pair"]
+            if xml_pair is not None:
                 # チェックタブ用に変換結果を記憶（複数保持・同名は上書き）
-                pair_name = f"{os.path.splitext(name)[0]}.xml"
-                replaced = False
-                for idx, pair in enumerate(st.session_state["check_xml_pairs"]):
-                    if pair["name"] == pair_name:
-                        st.session_state["check_xml_pairs"][idx] = {
-                            "name": pair_name,
-                            "original": data,
-                            "converted": xml_bytes,
-                        }
-                        replaced = True
-                        break
-                if not replaced:
-                    st.session_state["check_xml_pairs"].append(
-                        {
-                            "name": pair_name,
-                            "original": data,
-                            "converted": xml_bytes,
-                        }
-                    )
-
-            else:
-                st.warning("未対応の拡張子です。")
+                st.session_state["check_xml_pairs"][xml_pair["name"]] = {
+                    "original": xml_pair["original"],
+                    "converted": xml_pair["converted"],
+                }
 
         if zip_download:
             zip_file.close()
             zip_buffer.seek(0)
+            # download_buttonはSpooledTemporaryFileを受け付けず、渡したデータも全体をメモリに保持するため
+            # ここで一度bytesに読み込む（ZIP全体分のメモリはこの時点で必要になる）
             st.download_button(
                 "ZIPをダウンロード",
-                data=zip_buffer.getvalue(),
+                data=zip_buffer.read(),
                 file_name="converted_outputs.zip",
                 mime="application/zip",
             )
+            zip_buffer.close()
 
     if preview_items:
         st.markdown("### プレビュー（元ファイル / 変換後）")
@@ -527,16 +443,13 @@ with tab_check:
     seg_tag = st.text_input("句タグ名", value="seg")
     check_odoriji = st.checkbox("踊り字を展開して文字数を数える", value=True)
 
-    stored_pairs = st.session_state.get("check_xml_pairs", [])
+    stored_pairs = st.session_state.get("check_xml_pairs", {})
     use_session = orig_file is None and conv_file is None and len(stored_pairs) > 0
     selected_pair = None
     if use_session:
-        names = [p["name"] for p in stored_pairs]
+        names = list(stored_pairs.keys())
         selected_name = st.selectbox("変換タブで生成したXMLから選択", names)
-        for p in stored_pairs:
-            if p["name"] == selected_name:
-                selected_pair = p
-                break
+        selected_pair = stored_pairs.get(selected_name)
 
     if (orig_file and conv_file) or use_session:
         if st.button("チェックする"):
@@ -545,7 +458,7 @@ with tab_check:
                 st.error("和歌UniDicのフォルダに dicrc が見つかりません。パスを確認してください。")
                 st.stop()
             try:
-                tagger = create_tagger(dic_dir_to_use, mecabrc_path or None, 20)
+                tagger = _cached_tagger(dic_dir_to_use, mecabrc_path or None, 20)
             except Exception as exc:
                 st.error(f"MeCabの初期化に失敗しました: {exc}")
                 st.stop()
@@ -554,12 +467,13 @@ with tab_check:
                 orig_data = selected_pair["original"]
                 conv_data = selected_pair["converted"]
             else:
-                orig_data = orig_file.read()
-                conv_data = conv_file.read()
+                orig_data = orig_file.getvalue()
+                conv_data = conv_file.getvalue()
 
-            orig_tree = _load_xml_with_sourceline(orig_data)
-            conv_tree = _load_xml_with_sourceline(conv_data)
-            if orig_tree is None or conv_tree is None:
+            try:
+                orig_tree = _parse_xml(orig_data)
+                conv_tree = _parse_xml(conv_data)
+            except LET.XMLSyntaxError:
                 st.error("XMLの読み込みに失敗しました。")
                 st.stop()
 
@@ -570,10 +484,28 @@ with tab_check:
 
             id_map, n_map, ordered = _map_original_l(orig_tree, l_tag)
 
+            # 全<l>の句をまとめてひらがな化し、句ごとの文字数だけを保持する
+            # （句は1つずつ単独でMeCabに通す。重複する句やキャッシュ済みの句は再解析しない）
+            seg_texts_by_line: Dict[int, List[str]] = {}
+            for idx, (l_elem, segs) in enumerate(l_items):
+                if len(segs) == 5:
+                    seg_texts_by_line[idx] = [_seg_text(s) for s in segs]
+            all_seg_texts = [t for texts in seg_texts_by_line.values() for t in texts]
+            seg_counts = [
+                len(hira)
+                for hira in convert_texts(all_seg_texts, tagger, check_odoriji, "hiragana")
+            ]
+
+            # 文字数を (行数, 5) の配列にして、5-7-5-7-7との不一致をまとめて判定する
+            counts_all = np.array(seg_counts, dtype=np.int32).reshape(-1, 5)
+            mismatch_all = counts_all != _EXPECTED_COUNTS
+            bad_mask = mismatch_all.any(axis=1)
+            row_of_line = {idx: i for i, idx in enumerate(seg_texts_by_line)}
+
             for idx, (l_elem, segs) in enumerate(l_items):
                 xml_id = l_elem.attrib.get("{http://www.w3.org/XML/1998/namespace}id", "")
                 n_attr = l_elem.attrib.get("n", "")
-                line_no = getattr(l_elem, "sourceline", None)
+                line_no = l_elem.sourceline
 
                 if len(segs) != 5:
                     structure_errors.append(
@@ -587,20 +519,17 @@ with tab_check:
                     )
                     continue
 
-                seg_texts = [_seg_text(s) for s in segs]
-                counts = []
-                for text in seg_texts:
-                    hira = convert_text(text, tagger, check_odoriji, "hiragana")
-                    counts.append(len(hira))
+                seg_texts = seg_texts_by_line[idx]
+                row_i = row_of_line[idx]
 
-                expected = [5, 7, 5, 7, 7]
-                if counts != expected:
+                if bad_mask[row_i]:
                     mismatch_rows.append(
                         {
                             "xml:id": xml_id,
                             "n": n_attr,
                             "line": line_no,
-                            "counts": counts,
+                            "counts": counts_all[row_i].tolist(),
+                            "mismatch_idx": np.nonzero(mismatch_all[row_i])[0].tolist(),
                         }
                     )
 
@@ -615,11 +544,9 @@ with tab_check:
 
                     orig_snippet = ""
                     if orig_l is not None:
-                        import xml.etree.ElementTree as ET
-
-                        seg_elems = [s for s in orig_l.iter() if _local_name(s.tag) == seg_tag]
+                        seg_elems = _XPATH_SELF_OR_DESCENDANT(orig_l, name=seg_tag)
                         orig_snippet = "\n".join(
-                            [ET.tostring(s, encoding="unicode") for s in seg_elems]
+                            [LET.tostring(s, encoding="unicode") for s in seg_elems]
                         )
 
                     edit_targets.append(
@@ -634,8 +561,7 @@ with tab_check:
                         edit_targets
                     ):
                         row = mismatch_rows[idx]
-                        expected = [5, 7, 5, 7, 7]
-                        mismatch_idx = [i for i, c in enumerate(row["counts"]) if c != expected[i]]
+                        mismatch_idx = row["mismatch_idx"]
                         st.markdown(
                             f"**対象: {label}**  "
                             f"(xml:id={row['xml:id']} / n={row['n']} / line={row['line']} "
@@ -0,0 +1,204 @@
+import functools
+import io
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import lxml.etree as LET
+
+from io_utils import (
+    convert_csv_bytes,
+    convert_docx_bytes,
+    convert_xml_bytes,
+    read_text_bytes,
+    texts_to_csv_bytes,
+    texts_to_txt_bytes,
+    texts_to_xml_bytes,
+    write_csv,
+    xml_tag_filter,
+)
+from mecab_utils import convert_text, convert_texts, create_tagger
+
+
+# ワーカープロセスごとのTagger（MeCab.Taggerはpickleできないため各プロセスで生成する）
+_TAGGER = None
+
+
+def init_worker(
+    dic_dir: Optional[str],
+    mecabrc_path: Optional[str] = None,
+    reading_field: int = 9,
+) -> None:
+    # ProcessPoolExecutorのinitializer: プロセス内で一度だけTaggerを生成する
+    global _TAGGER
+    _TAGGER = create_tagger(dic_dir, mecabrc_path, reading_field)
+
+
+def _as_output_bytes(
+    output_format: str,
+    texts: List[str],
+) -> Tuple[bytes, str]:
+    # 指定形式に合わせて出力バイト列とMIMEを返す
+    if output_format == "txt":
+        return texts_to_txt_bytes(texts), "text/plain"
+    if output_format == "csv":
+        return texts_to_csv_bytes(texts), "text/csv"
+    if output_format == "xml":
+        return texts_to_xml_bytes(texts), "application/xml"
+    raise ValueError(f"Unsupported output format: {output_format}")
+
+
+def _collect_snippets_stream(data: bytes, tag: str) -> Iterator[str]:
+    # 1パスで指定タグの要素を文書順（開始タグ順）に文字列化する（出力済みの要素は解放してメモリを抑える）
+    tag_filter = xml_tag_filter(tag)
+    if tag_filter is None:
+        # 不正なタグには何も一致しない
+        return
+    depth = 0
+    pending: List[LET._Element] = []
+    events = ("start", "end")
+    for event, elem in LET.iterparse(io.BytesIO(data), events=events, tag=tag_filter):
+        if event == "start":
+            # 同名タグの入れ子では外側が先になるよう開始時に順番を記録しておく
+            depth += 1
+            pending.append(elem)
+            continue
+        depth -= 1
+        if depth == 0:
+            # 外側の要素が閉じた時点で中身が揃うので、まとめて出力してから解放する
+            for snippet_elem in pending:
+                yield LET.tostring(snippet_elem, encoding="unicode", with_tail=False)
+            pending.clear()
+            elem.clear(keep_tail=True)
+
+
+def process_file(
+    name: str,
+    data: bytes,
+    ext: str,
+    options: Dict[str, object],
+    tagger=None,
+) -> Dict[str, object]:
+    # 1ファイルを変換し、出力・プレビュー・チェック用XMLをまとめて返す
+    # （画面表示は呼び出し側で行うため、ここではStreamlitを使わない）
+    tagger = tagger if tagger is not None else _TAGGER
+    expand_odoriji = options["expand_odoriji"]
+    output_mode = options["output_mode"]
+    output_format = options["output_format"]
+    xml_tag = options["xml_tag"]
+    csv_column = options["csv_column"]
+    # 各形式の変換で共通に使う一括変換関数（設定をまとめて束縛しておく）
+    convert_many = functools.partial(
+        convert_texts,
+        tagger=tagger,
+        expand_odoriji=expand_odoriji,
+        output_mode=output_mode,
+    )
+
+    result: Dict[str, object] = {
+        "outputs": [],
+        "preview": None,
+        "xml_pair": None,
+        "error": None,
+        "warning": None,
+    }
+    outputs = result["outputs"]
+
+    if ext == ".txt":
+        # txt: 全文を変換
+        text = read_text_bytes(data)
+        converted = convert_text(text, tagger, expand_odoriji, output_mode)
+        out_bytes, mime = _as_output_bytes(output_format, [converted])
+        out_name = f"{os.path.splitext(name)[0]}.{output_format}"
+        outputs.append(("ダウンロード", out_name, out_bytes, mime))
+        result["preview"] = (out_name, text, converted)
+
+    elif ext == ".docx":
+        # docx: 段落ごとに変換してtxt/docx両方出力
+        txt_bytes, docx_bytes = convert_docx_bytes(
+            data,
+            convert_many,
+        )
+        base = os.path.splitext(name)[0]
+        outputs.append(("TXTをダウンロード", f"{base}.txt", txt_bytes, "text/plain"))
+        outputs.append(
+            (
+                "DOCXをダウンロード",
+                f"{base}.docx",
+                docx_bytes,
+                "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            )
+        )
+        try:
+            preview_text = txt_bytes.decode("utf-8-sig", errors="replace")
+            result["preview"] = (f"{base}.txt", preview_text, preview_text)
+        except Exception:
+            pass
+
+    elif ext == ".csv":
+        # csv: 指定列のみ変換して構造を保持
+        try:
+            df, original_col = convert_csv_bytes(
+                data,
+                csv_column,
+                convert_many,
+            )
+        except KeyError as exc:
+            result["error"] = str(exc)
+            return result
+        converted_texts = df[csv_column].astype(str).tolist()
+        if output_format == "csv":
+            out_bytes = write_csv(df)
+            out_name = f"{os.path.splitext(name)[0]}.csv"
+            outputs.append(("ダウンロード", out_name, out_bytes, "text/csv"))
+        else:
+            out_bytes, mime = _as_output_bytes(output_format, converted_texts)
+            out_name = f"{os.path.splitext(name)[0]}.{output_format}"
+            outputs.append(("ダウンロード", out_name, out_bytes, mime))
+        result["preview"] = (out_name, "\n".join(original_col), "\n".join(converted_texts))
+
+    elif ext == ".xml":
+        # xml: 指定タグ配下のテキストのみ変換
+        try:
+            xml_bytes, texts = convert_xml_bytes(
+                data,
+                xml_tag,
+                convert_many,
+                pre_expand_odoriji=expand_odoriji,
+                collect_texts=output_format != "xml",
+            )
+        except Exception as exc:
+            result["error"] = f"XMLの読み込みに失敗しました: {exc}"
+            return result
+
+        if output_format == "xml":
+            # xmlとして出力
+            out_name = f"{os.path.splitext(name)[0]}.xml"
+            outputs.append(("ダウンロード", out_name, xml_bytes, "application/xml"))
+            try:
+                orig_snippets = list(_collect_snippets_stream(data, xml_tag))
+                conv_snippets = list(_collect_snippets_stream(xml_bytes, xml_tag))
+                result["preview"] = (out_name, "\n".join(orig_snippets), "\n".join(conv_snippets))
+            except Exception:
+                pass
+        else:
+            # xml以外の場合は変換時に集めた本文だけを出力
+            out_bytes, mime = _as_output_bytes(output_format, texts)
+            out_name = f"{os.path.splitext(name)[0]}.{output_format}"
+            outputs.append(("ダウンロード", out_name, out_bytes, mime))
+            try:
+                orig_snippets = list(_collect_snippets_stream(data, xml_tag))
+                result["preview"] = (out_name, "\n".join(orig_snippets), "\n".join(texts))
+            except Exception:
+                pass
+
+        # チェックタブ用に変換結果を返す
+        result["xml_pair"] = {
+            "name": f"{os.path.splitext(name)[0]}.xml",
+            "original": data,
+            "converted": xml_bytes,
+        }
+
+    else:
+        result["warning"] = "未対応の拡張子です。"
+
+    return result
@@ -1,43 +1,61 @@
 from __future__ import annotations
 
+import codecs
 import io
-from typing import Iterable, Tuple
 import re
-import xml.etree.ElementTree as ET
+from typing import Iterable, List, Optional, Tuple
 
+import charset_normalizer
+import lxml.etree as LET
 import pandas as pd
 from docx import Document
 
+from mecab_utils import pre_expand_odoriji as _pre_expand_text
+
+
+# XMLの要素名（名前空間接頭辞なし）として使える文字列か判定する（NCNameの簡易判定）
+_NCNAME_RE = re.compile(r"[^\W\d][\w.\-\u00B7]*")
+
+# XML 1.0で使えない制御文字など（出力時に取り除く）
+_XML_ILLEGAL_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
 
 def read_text_bytes(data: bytes) -> str:
-    # 文字コードを推定してテキストに変換
-    for enc in ("utf-8-sig", "utf-8", "cp932"):
+    # 文字コードを推定してテキストに変換（BOM → UTF-8 → cp932 → charset_normalizerの順）
+    if data.startswith(codecs.BOM_UTF8):
+        try:
+            return data[len(codecs.BOM_UTF8):].decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+    for enc in ("utf-8", "cp932"):
         try:
             return data.decode(enc)
         except UnicodeDecodeError:
             continue
+    best = charset_normalizer.from_bytes(data).best()
+    if best is not None:
+        return str(best)
     return data.decode("utf-8", errors="replace")
 
 
 def write_csv(df: pd.DataFrame) -> bytes:
     # CSVをUTF-8(BOM付き)で出力
-    buffer = io.StringIO()
-    df.to_csv(buffer, index=False)
-    return buffer.getvalue().encode("utf-8-sig")
+    buffer = io.BytesIO()
+    df.to_csv(buffer, index=False, encoding="utf-8-sig")
+    return buffer.getvalue()
 
 
 def convert_docx_bytes(
     data: bytes,
-    convert_func,
+    convert_texts_func,
 ) -> Tuple[bytes, bytes]:
-    # docxの段落テキストを変換し、txtとdocxの両方を返す
+    # docxの段落テキストをまとめて変換し、txtとdocxの両方を返す
+    # （本文はParagraphオブジェクトを作らずw:p要素から直接読み、出力は新しい文書に段落として書く）
     doc = Document(io.BytesIO(data))
     out_doc = Document()
-    text_lines = []
-    for para in doc.paragraphs:
-        converted = convert_func(para.text)
+    text_lines = convert_texts_func([paragraph.text for paragraph in doc.element.body.p_lst])
+    for converted in text_lines:
         out_doc.add_paragraph(converted)
-        text_lines.append(converted)
 
     text_bytes = ("\n".join(text_lines)).encode("utf-8-sig")
     out_stream = io.BytesIO()
@@ -48,149 +66,102 @@ def convert_docx_bytes(
 def convert_csv_bytes(
     data: bytes,
     text_column: str,
-    convert_func,
-) -> pd.DataFrame:
-    # CSVを読み込み、指定列だけ変換してDataFrameで返す
-    df = None
-    for enc in ("utf-8-sig", "utf-8", "cp932"):
-        try:
-            df = pd.read_csv(io.BytesIO(data), encoding=enc)
-            break
-        except Exception:
-            df = None
-    if df is None:
-        df = pd.read_csv(io.BytesIO(data), encoding="utf-8", errors="replace")
+    convert_texts_func,
+) -> Tuple[pd.DataFrame, List[str]]:
+    # CSVを読み込み、指定列だけまとめて変換してDataFrameと変換前の列を返す
+    # 文字コードの判定と復号は1回だけ行い、文字列のままCエンジンで1回で読み込む
+    # 変換対象列は数値として解釈させず、元の表記（先頭の0など）を保つ
+    df = pd.read_csv(
+        io.StringIO(read_text_bytes(data)),
+        engine="c",
+        dtype={text_column: str},
+        low_memory=False,
+    )
 
     if text_column not in df.columns:
         raise KeyError(f"Column not found: {text_column}")
 
-    df[text_column] = df[text_column].astype(str).map(convert_func)
-    return df
-
-
-def _local_name(tag: str) -> str:
-    # 名前空間付きタグからローカル名だけを取り出す
-    if "}" in tag:
-        return tag.split("}", 1)[1]
-    return tag
-
-
-def _register_namespaces(xml_text: str) -> None:
-    # 元XMLの名前空間宣言を登録して、出力時のns0化を防ぐ
-    for match in re.finditer(r'xmlns(?::([\\w.-]+))?="([^"]+)"', xml_text):
-        prefix, uri = match.group(1), match.group(2)
-        if prefix is None:
-            ET.register_namespace("", uri)
-        else:
-            ET.register_namespace(prefix, uri)
-
-
-def _is_hiragana(ch: str) -> bool:
-    return 0x3041 <= ord(ch) <= 0x3096
-
-
-def _dakuten_map() -> dict[str, str]:
-    return {
-        "か": "が",
-        "き": "ぎ",
-        "く": "ぐ",
-        "け": "げ",
-        "こ": "ご",
-        "さ": "ざ",
-        "し": "じ",
-        "す": "ず",
-        "せ": "ぜ",
-        "そ": "ぞ",
-        "た": "だ",
-        "ち": "ぢ",
-        "つ": "づ",
-        "て": "で",
-        "と": "ど",
-        "は": "ば",
-        "ひ": "び",
-        "ふ": "ぶ",
-        "へ": "べ",
-        "ほ": "ぼ",
-        "う": "ゔ",
-    }
-
-
-def _pre_expand_odoriji_in_element(elem: ET.Element) -> None:
+    column = df[text_column].astype(str)
+    # 同じ文字列（繰り返しの句や見出しなど）は1回だけ変換して列全体に割り当てる
+    uniques = pd.unique(column)
+    converted = dict(zip(uniques, convert_texts_func(list(uniques))))
+    df[text_column] = column.map(converted)
+    return df, column.tolist()
+
+
+def xml_tag_filter(tag: str) -> Optional[str]:
+    # 名前空間を問わず指定タグに一致するiterparse用の絞り込みを返す
+    # （空や要素名として不正なタグは「*」などのパターン扱いにならないようNoneを返す）
+    if not tag or not _NCNAME_RE.fullmatch(tag):
+        return None
+    return f"{{*}}{tag}"
+
+
+def _pre_expand_odoriji_in_element(elem: LET._Element) -> None:
     # <l>内の全テキストをタグ無視で走査し、踊り字を事前展開する
-    dakuten = _dakuten_map()
-    prev = ""
-
-    def process_text(text: str) -> str:
-        nonlocal prev
-        if not text:
-            return text
-        out = []
-        for ch in text:
-            if ch in ("ゝ", "ヽ"):
-                if _is_hiragana(prev):
-                    out.append(prev)
-                else:
-                    out.append(ch)
-                continue
-            if ch in ("ゞ", "ヾ"):
-                if _is_hiragana(prev):
-                    replaced = dakuten.get(prev, prev)
-                    out.append(replaced)
-                    prev = replaced
-                else:
-                    out.append(ch)
-                continue
-            out.append(ch)
-            prev = ch
-        return "".join(out)
-
-    def walk(node: ET.Element) -> None:
-        if node.text:
-            node.text = process_text(node.text)
-        for child in list(node):
-            walk(child)
-            if child.tail:
-                child.tail = process_text(child.tail)
-
-    walk(elem)
-
-
-def _convert_text_in_element(elem: ET.Element, convert_func) -> None:
-    # 指定要素配下のテキストとtailを再帰的に変換
-    if elem.text:
-        elem.text = convert_func(elem.text)
-    for child in list(elem):
-        _convert_text_in_element(child, convert_func)
-        if child.tail:
-            child.tail = convert_func(child.tail)
+    slots: List[Tuple[LET._Element, str]] = []
+    _collect_text_slots(elem, slots)
+    pieces = [getattr(node, attr) for node, attr in slots]
+    # 連結して一度に展開し、元の長さで切り戻す（展開しても文字数は変わらない）
+    expanded = _pre_expand_text("".join(pieces))
+    pos = 0
+    for (node, attr), piece in zip(slots, pieces):
+        setattr(node, attr, expanded[pos:pos + len(piece)])
+        pos += len(piece)
+
+
+def _collect_text_slots(elem: LET._Element, slots: List[Tuple[LET._Element, str]]) -> None:
+    # 指定要素配下のテキストとtailの位置を文書順に集める（再帰せずiterwalkでC側で走査する）
+    for event, node in LET.iterwalk(elem, events=("start", "end")):
+        if event == "start":
+            if node.text:
+                slots.append((node, "text"))
+        elif node is not elem and node.tail:
+            slots.append((node, "tail"))
 
 
 def convert_xml_bytes(
     data: bytes,
     text_tag: str,
-    convert_func,
+    convert_texts_func,
     pre_expand_odoriji: bool = False,
-) -> bytes:
-    # XMLを読み込み、指定タグ配下のテキストのみを変換する
-    try:
-        xml_text = data.decode("utf-8")
-    except UnicodeDecodeError:
-        xml_text = data.decode("utf-8", errors="replace")
-    _register_namespaces(xml_text)
-
-    tree = ET.ElementTree(ET.fromstring(data))
-    root = tree.getroot()
-
-    for elem in root.iter():
-        if _local_name(elem.tag) != text_tag:
+    collect_texts: bool = False,
+) -> Tuple[bytes, Optional[List[str]]]:
+    # XMLを1パスで読み込み、指定タグ配下のテキストのみをまとめて変換する
+    # collect_textsが真なら、変換後の指定タグごとの本文も一緒に返す（再パース不要にするため）
+    # （lxmlは名前空間の接頭辞をそのまま保持し、タグの絞り込みもC側で行う。コメント/PIは従来どおり除く）
+    # タグが不正な場合は何も一致させず、文書全体を読み込むだけにする
+    depth = 0
+    slots: List[Tuple[LET._Element, str]] = []
+    matched: List[LET._Element] = []
+    tag = xml_tag_filter(text_tag)
+    context = LET.iterparse(
+        io.BytesIO(data),
+        events=("start", "end") if tag else (),
+        tag=tag,
+        remove_comments=True,
+        remove_pis=True,
+    )
+    for event, elem in context:
+        if event == "start":
+            depth += 1
+            if collect_texts:
+                matched.append(elem)
             continue
-        if pre_expand_odoriji:
-            _pre_expand_odoriji_in_element(elem)
-        _convert_text_in_element(elem, convert_func)
+        depth -= 1
+        if depth == 0:
+            # 同名タグが入れ子の場合は外側の要素でまとめて処理する
+            if pre_expand_odoriji:
+                _pre_expand_odoriji_in_element(elem)
+            _collect_text_slots(elem, slots)
+
+    converted = convert_texts_func([getattr(node, attr) for node, attr in slots])
+    for (node, attr), text in zip(slots, converted):
+        setattr(node, attr, text)
 
-    out = io.BytesIO()
-    tree.write(out, encoding="utf-8", xml_declaration=True)
-    return out.getvalue()
+    texts = ["".join(elem.itertext()) for elem in matched] if collect_texts else None
+    xml_bytes = LET.tostring(context.root.getroottree(), encoding="utf-8", xml_declaration=True)
+    return xml_bytes, texts
 
 
 def texts_to_txt_bytes(texts: Iterable[str]) -> bytes:
@@ -206,10 +177,9 @@ def texts_to_csv_bytes(texts: Iterable[str]) -> bytes:
 
 def texts_to_xml_bytes(texts: Iterable[str]) -> bytes:
     # テキスト配列を <root><text>...</text></root> 形式で出力
-    root = ET.Element("root")
+    # （XMLに書けない制御文字は取り除く）
+    root = LET.Element("root")
     for t in texts:
-        elem = ET.SubElement(root, "text")
-        elem.text = t
-    out = io.BytesIO()
-    ET.ElementTree(root).write(out, encoding="utf-8", xml_declaration=True)
-    return out.getvalue()
\ No newline at end of file
+        elem = LET.SubElement(root, "text")
+        elem.text = _XML_ILLEGAL_RE.sub("", t)
+    return LET.tostring(root, encoding="utf-8", xml_declaration=True)
\ No newline at end of file
@@ -1,37 +1,96 @@
+import functools
 import re
 import os
-from typing import Optional
+import threading
+import weakref
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 
 import MeCab
 
 
-# カタカナ/ひらがな判定用の正規表現
-_KATAKANA_RE = re.compile(r"^[\u30A1-\u30FA\u30FC]+$")
-_HIRAGANA_RE = re.compile(r"^[\u3041-\u3096\u309D\u309E]+$")
+# かな変換用のstr.translateテーブル（ァ-ヶ ⇔ ぁ-ゖ）
+_KATA_TO_HIRA_TABLE = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+_HIRA_TO_KATA_TABLE = {code: code + 0x60 for code in range(0x3041, 0x3097)}
 
+# 踊り字（ゝゞヽヾ）の展開用：直前の文字と続く踊り字の並びを捕まえる
+# MeCab前の展開は直前がひらがなの場合のみ
+_ODORI_CHARS = frozenset("ゝゞヽヾ")
+_ODORI_RE = re.compile(r"([^ゝゞヽヾ])([ゝゞヽヾ]+)")
+_PRE_ODORI_RE = re.compile(r"([\u3041-\u3096])([ゝゞヽヾ]+)")
 
-def _kata_to_hira(text: str) -> str:
-    # カタカナをひらがなに変換（それ以外は保持）
-    result = []
-    for ch in text:
-        code = ord(ch)
-        if 0x30A1 <= code <= 0x30F6:
-            result.append(chr(code - 0x60))
-        else:
-            result.append(ch)
-    return "".join(result)
+# ゞ/ヾで濁音化する文字
+_DAKUTEN_HIRA = {
+    "か": "が",
+    "き": "ぎ",
+    "く": "ぐ",
+    "け": "げ",
+    "こ": "ご",
+    "さ": "ざ",
+    "し": "じ",
+    "す": "ず",
+    "せ": "ぜ",
+    "そ": "ぞ",
+    "た": "だ",
+    "ち": "ぢ",
+    "つ": "づ",
+    "て": "で",
+    "と": "ど",
+    "は": "ば",
+    "ひ": "び",
+    "ふ": "ぶ",
+    "へ": "べ",
+    "ほ": "ぼ",
+    "う": "ゔ",
+}
+_DAKUTEN_KATA = {
+    "カ": "ガ",
+    "キ": "ギ",
+    "ク": "グ",
+    "ケ": "ゲ",
+    "コ": "ゴ",
+    "サ": "ザ",
+    "シ": "ジ",
+    "ス": "ズ",
+    "セ": "ゼ",
+    "ソ": "ゾ",
+    "タ": "ダ",
+    "チ": "ヂ",
+    "ツ": "ヅ",
+    "テ": "デ",
+    "ト": "ド",
+    "ハ": "バ",
+    "ヒ": "ビ",
+    "フ": "ブ",
+    "ヘ": "ベ",
+    "ホ": "ボ",
+    "ウ": "ヴ",
+}
+_DAKUTEN = {**_DAKUTEN_HIRA, **_DAKUTEN_KATA}
 
+# \n以外で改行とみなす文字（CRLFの\rなど）。MeCabの出力では形態素の表層から取り除く
+_LINE_BREAKS = "\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
 
-def _hira_to_kata(text: str) -> str:
-    # ひらがなをカタカナに変換（それ以外は保持）
-    result = []
-    for ch in text:
-        code = ord(ch)
-        if 0x3041 <= code <= 0x3096:
-            result.append(chr(code + 0x60))
-        else:
-            result.append(ch)
-    return "".join(result)
+# 変換結果のキャッシュ（Taggerごと・最大件数を超えたら古いものから破棄）
+# キーは (テキスト, 踊り字展開の有無, 出力モード)
+# 行・句・セル程度の短いテキストだけを保持する（txt全文のような長いテキストはキャッシュしない）
+_CacheKey = Tuple[str, bool, str]
+_RESULT_CACHE_SIZE = 1 << 14
+_RESULT_CACHE_MAX_TEXT_LEN = 256
+_RESULT_CACHES: "weakref.WeakKeyDictionary[MeCab.Tagger, OrderedDict[_CacheKey, str]]" = (
+    weakref.WeakKeyDictionary()
+)
+_RESULT_CACHE_LOCK = threading.Lock()
+
+# Tagger.parseはスレッドセーフではないため、セッション間でTaggerを共有しても同時に呼ばない
+_PARSE_LOCK = threading.Lock()
+
+
+def _kana_table(output_mode: str) -> dict:
+    # 出力モードに合わせた読みの変換テーブル（カタカナ出力ならひらがな→カタカナ、それ以外は逆）
+    if output_mode == "katakana":
+        return _HIRA_TO_KATA_TABLE
+    return _KATA_TO_HIRA_TABLE
 
 
 def _pick_reading(feature: str, surface: str) -> str:
@@ -41,91 +100,21 @@ def _pick_reading(feature: str, surface: str) -> str:
     return feature
 
 
-def _dakuten_map() -> dict[str, str]:
-    return {
-        "か": "が",
-        "き": "ぎ",
-        "く": "ぐ",
-        "け": "げ",
-        "こ": "ご",
-        "さ": "ざ",
-        "し": "じ",
-        "す": "ず",
-        "せ": "ぜ",
-        "そ": "ぞ",
-        "た": "だ",
-        "ち": "ぢ",
-        "つ": "づ",
-        "て": "で",
-        "と": "ど",
-        "は": "ば",
-        "ひ": "び",
-        "ふ": "ぶ",
-        "へ": "べ",
-        "ほ": "ぼ",
-        "う": "ゔ",
-        "カ": "ガ",
-        "キ": "ギ",
-        "ク": "グ",
-        "ケ": "ゲ",
-        "コ": "ゴ",
-        "サ": "ザ",
-        "シ": "ジ",
-        "ス": "ズ",
-        "セ": "ゼ",
-        "ソ": "ゾ",
-        "タ": "ダ",
-        "チ": "ヂ",
-        "ツ": "ヅ",
-        "テ": "デ",
-        "ト": "ド",
-        "ハ": "バ",
-        "ヒ": "ビ",
-        "フ": "ブ",
-        "ヘ": "ベ",
-        "ホ": "ボ",
-        "ウ": "ヴ",
-    }
-
-
 def _expand_odoriji(text: str) -> str:
     # かな変換後の踊り字展開（ゝゞヽヾの残りを処理）
-    dakuten = _dakuten_map()
-    result = []
-    prev = ""
-    for ch in text:
-        if ch in ("ゝ", "ヽ"):
-            result.append(prev if prev else ch)
-        elif ch in ("ゞ", "ヾ"):
-            result.append(dakuten.get(prev, prev if prev else ch))
-        else:
-            result.append(ch)
-            prev = ch
-    return "".join(result)
+    return _ODORI_RE.sub(_repeat_odoriji, text)
 
 
-def _is_hiragana(ch: str) -> bool:
-    return bool(_HIRAGANA_RE.match(ch))
+def pre_expand_odoriji(text: str) -> str:
+    # MeCab前の踊り字展開（前の文字がひらがなの場合のみ）
+    return _PRE_ODORI_RE.sub(_repeat_odoriji, text)
 
 
-def _pre_expand_odoriji(text: str) -> str:
-    # MeCab前の踊り字展開（前の文字がひらがなの場合のみ）
-    dakuten = _dakuten_map()
-    result = []
-    prev = ""
-    for ch in text:
-        if ch in ("ゝ", "ヽ"):
-            result.append(prev if _is_hiragana(prev) else ch)
-            continue
-        if ch in ("ゞ", "ヾ"):
-            if _is_hiragana(prev):
-                result.append(dakuten.get(prev, prev))
-            else:
-                result.append(ch)
-            continue
-        result.append(ch)
-        prev = ch
-    return "".join(result)
+def _repeat_odoriji(match: "re.Match[str]") -> str:
+    # 直前の文字の繰り返しに置き換える（連続する踊り字も同じ文字を繰り返す）
+    prev, marks = match.group(1), match.group(2)
+    voiced = _DAKUTEN.get(prev, prev)
+    return prev + "".join(prev if mark in "ゝヽ" else voiced for mark in marks)
 
 
 def _default_mecabrc() -> Optional[str]:
@@ -144,11 +133,14 @@ def _default_mecabrc() -> Optional[str]:
     return None
 
 
+@functools.lru_cache(maxsize=8)
 def create_tagger(
     dic_dir: Optional[str],
     mecabrc_path: Optional[str] = None,
     reading_field: int = 9,
 ) -> MeCab.Tagger:
+    # 辞書の読み込みは重いため、同じ設定のTaggerはプロセス内で使い回す
+    # （parseは_PARSE_LOCKで直列化しているので共有しても安全）
     args = []
     mecabrc = mecabrc_path or _default_mecabrc()
     if mecabrc:
@@ -162,42 +154,123 @@ def create_tagger(
     return MeCab.Tagger(" ".join(args))
 
 
-def convert_text(
-    text: str,
-    tagger: MeCab.Tagger,
-    expand_odoriji: bool = False,
-    output_mode: str = "hiragana",
-) -> str:
-    # 形態素解析の前に踊り字を簡易展開（有効時のみ）
-    if expand_odoriji:
-        text = _pre_expand_odoriji(text)
+def _finish_kana(readings: List[str], expand_odoriji: bool) -> str:
+    # かなに揃えた読みを連結し、必要なら残った踊り字を展開する
+    kana = "".join(readings)
+    # 事前展開でほとんどの踊り字は消えているため、残っている場合だけ展開する
+    if expand_odoriji and not _ODORI_CHARS.isdisjoint(kana):
+        kana = _expand_odoriji(kana)
+    return kana
 
-    # MeCabの出力は「表層\t読み」形式（EOSで終わる）
-    parsed = tagger.parse(text)
-    if parsed is None:
-        return text
 
-    out = []
+def _split_readings(parsed: str, table: dict) -> List[str]:
+    # MeCabの出力（「表層\t読み」形式、EOSで終わる）から読みを取り出し、形態素ごとにtableでかなを揃える
+    readings: List[str] = []
+    # 形態素ごとに呼ぶ関数・定数はローカル変数に束縛して属性・グローバル参照を減らす
+    append = readings.append
+    pick_reading = _pick_reading
+    line_breaks = _LINE_BREAKS
     prev_reading = ""
-    for line in parsed.splitlines():
-        if line == "EOS" or not line:
+    for line in parsed.split("\n"):
+        if not line or line == "EOS":
+            continue
+        surface, sep, feature = line.partition("\t")
+        surface = surface.strip(line_breaks)
+        if not surface:
             continue
-        if "\t" not in line:
-            out.append(line)
+        if not sep:
+            append(surface.translate(table))
             continue
-        surface, feature = line.split("\t", 1)
         # 〳〵は直前の形態素読みを繰り返す
         if surface == "〳〵" and prev_reading:
-            out.append(prev_reading)
+            append(prev_reading)
             continue
-        reading = _pick_reading(feature, surface)
-        out.append(reading)
+        reading = pick_reading(feature, surface).translate(table)
+        append(reading)
         prev_reading = reading
+    return readings
+
 
-    hira = _kata_to_hira("".join(out))
+def _convert_one(
+    text: str,
+    tagger: MeCab.Tagger,
+    expand_odoriji: bool,
+    output_mode: str,
+) -> str:
+    # 形態素解析の前に踊り字を簡易展開（有効時のみ）
     if expand_odoriji:
-        # かな化後に残った踊り字を展開
-        hira = _expand_odoriji(hira)
-    if output_mode == "katakana":
-        return _hira_to_kata(hira)
-    return hira
+        text = pre_expand_odoriji(text)
+
+    # テキストは1件ずつMeCabに渡す（連結すると境界の前後で分割が変わり、読みも変わるため）
+    with _PARSE_LOCK:
+        parsed = tagger.parse(text)
+    if parsed is None:
+        return text
+    return _finish_kana(_split_readings(parsed, _kana_table(output_mode)), expand_odoriji)
+
+
+def _result_cache(tagger: MeCab.Tagger) -> "OrderedDict[_CacheKey, str]":
+    # Taggerごとの変換結果キャッシュを返す（Taggerが破棄されるとキャッシュも消える）
+    with _RESULT_CACHE_LOCK:
+        cache = _RESULT_CACHES.get(tagger)
+        if cache is None:
+            cache = OrderedDict()
+            _RESULT_CACHES[tagger] = cache
+        return cache
+
+
+def _cache_get(
+    cache: "OrderedDict[_CacheKey, str]",
+    key: _CacheKey,
+) -> Optional[str]:
+    with _RESULT_CACHE_LOCK:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(
+    cache: "OrderedDict[_CacheKey, str]",
+    key: _CacheKey,
+    value: str,
+) -> None:
+    # 長いテキストは保持しない。上限を超えたら最も古い結果から捨てる（LRU）
+    if len(key[0]) > _RESULT_CACHE_MAX_TEXT_LEN:
+        return
+    with _RESULT_CACHE_LOCK:
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > _RESULT_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def convert_text(
+    text: str,
+    tagger: MeCab.Tagger,
+    expand_odoriji: bool = False,
+    output_mode: str = "hiragana",
+) -> str:
+    # 1件だけの変換も一括変換（キャッシュ込み）と同じ経路を通す
+    return convert_texts([text], tagger, expand_odoriji, output_mode)[0]
+
+
+def convert_texts(
+    texts: List[str],
+    tagger: MeCab.Tagger,
+    expand_odoriji: bool = False,
+    output_mode: str = "hiragana",
+) -> List[str]:
+    # キャッシュに無いテキストだけを重複を除いてMeCabで変換する
+    cache = _result_cache(tagger)
+    results = [_cache_get(cache, (t, expand_odoriji, output_mode)) for t in texts]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        uniq = list(dict.fromkeys(texts[i] for i in missing))
+        converted = [_convert_one(t, tagger, expand_odoriji, output_mode) for t in uniq]
+        mapping = dict(zip(uniq, converted))
+        for text, result in mapping.items():
+            _cache_put(cache, (text, expand_odoriji, output_mode), result)
+        for i in missing:
+            results[i] = mapping[texts[i]]
+    return results